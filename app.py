@@ -1,59 +1,144 @@
 import os
-from datetime import datetime, timedelta
-from flask import Flask, render_template, request, jsonify, redirect, url_for
+import secrets
+import shutil
+import threading
+from datetime import date, datetime, timedelta, timezone
+import orjson
+from cachetools import TTLCache, cached
+from flask import Flask, abort, render_template, request, jsonify, redirect, url_for
+from flask.json.provider import DefaultJSONProvider
+from jinja2 import FileSystemBytecodeCache
 from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy import inspect
-from werkzeug.utils import secure_filename
+from sqlalchemy import event, func, insert, select, text
+from sqlalchemy.orm import deferred, lazyload, raiseload
+from sqlalchemy.schema import CreateIndex
+
+# --- Sérialisation JSON via orjson (utilisée par jsonify) ---
+class ORJSONProvider(DefaultJSONProvider):
+    def dumps(self, obj, **kwargs):
+        option = orjson.OPT_SERIALIZE_DATACLASS
+        if self.sort_keys:
+            option |= orjson.OPT_SORT_KEYS
+        if kwargs.get('indent'):
+            option |= orjson.OPT_INDENT_2
+        return orjson.dumps(obj, default=str, option=option).decode()
+
+
+class ORJSONFlask(Flask):
+    json_provider_class = ORJSONProvider
+
 
 # --- Configuration de base ---
-app = Flask(__name__)
+app = ORJSONFlask(__name__)
 
 # Render n'autorise pas /var/data, donc on stocke en local dans /tmp ou /app/uploads
 BASE_DIR = os.path.abspath(os.path.dirname(__file__))
 UPLOAD_FOLDER = os.path.join(BASE_DIR, 'uploads')
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
+# Taille de tampon pour la copie des fichiers envoyés (1 Mio)
+COPY_BUFSIZE = 1 << 20
+UPLOAD_FOLDER_BYTES = os.fsencode(UPLOAD_FOLDER)
+# Taille maximale d'une page renvoyée par les API paginées
+MAX_PAGE_SIZE = 500
+# Extensions acceptées pour les photos (les noms sur disque sont générés)
+ALLOWED_IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.gif', '.webp')
 
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///cats.db'
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+# STRICT_LOADS=1 (dev/test) : tout accès à une relation non préchargée lève une erreur
+app.config['STRICT_LOADS'] = os.environ.get('STRICT_LOADS') == '1'
+# Pool de connexions partagé entre threads pour que les lectures WAL s'exécutent en parallèle
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+    'connect_args': {'check_same_thread': False, 'timeout': 30},
+    'pool_size': 8,
+    'max_overflow': 16,
+}
+
+# Bytecode Jinja conservé sur disque : les templates ne sont compilés qu'une fois pour tous les workers
+JINJA_CACHE_DIR = os.path.join(BASE_DIR, 'jinja_cache')
+os.makedirs(JINJA_CACHE_DIR, exist_ok=True)
+app.jinja_env.bytecode_cache = FileSystemBytecodeCache(JINJA_CACHE_DIR)
+
+# Pas d'expiration après commit : évite un SELECT implicite si l'objet est relu ensuite
+db = SQLAlchemy(app, session_options={'expire_on_commit': False})
+
+
+# --- Réglages SQLite appliqués à chaque connexion ---
+def _sqlite_pragmas(dbapi_conn, _):
+    cur = dbapi_conn.cursor()
+    cur.execute("PRAGMA journal_mode=WAL")
+    cur.execute("PRAGMA synchronous=NORMAL")
+    cur.execute("PRAGMA cache_size=-20000")
+    cur.execute("PRAGMA temp_store=MEMORY")
+    cur.execute("PRAGMA mmap_size=268435456")
+    cur.execute("PRAGMA foreign_keys=ON")
+    cur.close()
+
 
-db = SQLAlchemy(app)
+with app.app_context():
+    event.listen(db.engine, "connect", _sqlite_pragmas)
 
 # --- Définition des modèles ---
+# Horodatages UTC naïfs (datetime.utcnow est déprécié). Les server_default couvrent les
+# insertions SQL brutes ; le défaut Python reste nécessaire pour les tables créées avant
+# leur ajout, que create_all() ne modifie pas.
+def utc_now():
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+
+def utc_today():
+    return datetime.now(timezone.utc).date()
+
+
 class Cat(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    name = db.Column(db.String(100), nullable=False)
+    name = db.Column(db.String(100), nullable=False, index=True)
     birthdate = db.Column(db.Date)
     status = db.Column(db.String(50))
     photo_filename = db.Column(db.String(200))
 
-    vaccinations = db.relationship('Vaccination', backref='cat', lazy=True)
-    notes = db.relationship('Note', backref='cat', lazy=True)
+    # Les trois collections de Cat croissent sans limite : pas de selectin par défaut, on les
+    # précharge par requête (selectinload) là où une vue les parcourt. Un Cat atteint via un
+    # rendez-vous (AppointmentCat.cat) ne tire ainsi ni notes, ni vaccinations, ni rendez-vous.
+    vaccinations = db.relationship('Vaccination', back_populates='cat')
+    notes = db.relationship('Note', back_populates='cat')
     appointments = db.relationship('AppointmentCat', back_populates='cat')
 
 
 class VaccineType(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(100), unique=True, nullable=False)
-    vaccinations = db.relationship('Vaccination', backref='vaccine_type', lazy=True)
+    vaccinations = db.relationship('Vaccination', back_populates='vaccine_type')
 
 
 class Vaccination(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     cat_id = db.Column(db.Integer, db.ForeignKey('cat.id'), nullable=False)
-    vaccine_type_id = db.Column(db.Integer, db.ForeignKey('vaccine_type.id'), nullable=False)
-    date = db.Column(db.Date, default=datetime.utcnow)
+    vaccine_type_id = db.Column(db.Integer, db.ForeignKey('vaccine_type.id'), nullable=False, index=True)
+    date = db.Column(db.Date, default=utc_today, server_default=func.current_date())
     lot = db.Column(db.String(100))
     veterinarian = db.Column(db.String(100))
     reaction = db.Column(db.String(255))
+    cat = db.relationship('Cat', back_populates='vaccinations')
+    vaccine_type = db.relationship('VaccineType', back_populates='vaccinations')
+
+    # Couvre la clé étrangère cat_id et la lecture par chat, de la plus récente à la plus ancienne
+    __table_args__ = (db.Index('ix_vaccination_cat_date', 'cat_id', db.desc('date')),)
 
 
 class Note(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     cat_id = db.Column(db.Integer, db.ForeignKey('cat.id'), nullable=False)
-    content = db.Column(db.Text)
+    # Texte potentiellement long : chargé seulement à l'accès (un SELECT par note), ou en
+    # amont avec undefer, p. ex. selectinload(Cat.notes).undefer(Note.content).
+    # En mode STRICT_LOADS, un accès sans undefer lève une erreur pour signaler le N+1.
+    content = deferred(db.Column(db.Text), raiseload=app.config['STRICT_LOADS'])
     file_name = db.Column(db.String(200))
-    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    created_at = db.Column(db.DateTime, default=utc_now, server_default=func.now())
+    cat = db.relationship('Cat', back_populates='notes')
+
+    __table_args__ = (db.Index('ix_note_cat_created', 'cat_id', db.desc('created_at')),)
 
 
 class Employee(db.Model):
@@ -65,57 +150,140 @@ class Appointment(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     date = db.Column(db.DateTime, nullable=False)
     location = db.Column(db.String(200))
-    employees = db.relationship('AppointmentEmployee', back_populates='appointment')
-    cats = db.relationship('AppointmentCat', back_populates='appointment')
+    employees = db.relationship('AppointmentEmployee', back_populates='appointment', lazy='selectin')
+    cats = db.relationship('AppointmentCat', back_populates='appointment', lazy='selectin')
+
+    __table_args__ = (db.Index('ix_appt_date_id', 'date', 'id'),)
 
 
 class AppointmentEmployee(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    appointment_id = db.Column(db.Integer, db.ForeignKey('appointment.id'))
-    employee_id = db.Column(db.Integer, db.ForeignKey('employee.id'))
+    appointment_id = db.Column(db.Integer, db.ForeignKey('appointment.id'), index=True)
+    employee_id = db.Column(db.Integer, db.ForeignKey('employee.id'), index=True)
     appointment = db.relationship('Appointment', back_populates='employees')
-    employee = db.relationship('Employee')
+    employee = db.relationship('Employee', lazy='selectin')
 
 
 class AppointmentCat(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    appointment_id = db.Column(db.Integer, db.ForeignKey('appointment.id'))
-    cat_id = db.Column(db.Integer, db.ForeignKey('cat.id'))
+    appointment_id = db.Column(db.Integer, db.ForeignKey('appointment.id'), index=True)
+    cat_id = db.Column(db.Integer, db.ForeignKey('cat.id'), index=True)
     appointment = db.relationship('Appointment', back_populates='cats')
-    cat = db.relationship('Cat', back_populates='appointments')
+    cat = db.relationship('Cat', back_populates='appointments', lazy='selectin')
 
 
-# --- Initialisation automatique de la base ---
-with app.app_context():
-    inspector = inspect(db.engine)
-    tables = inspector.get_table_names()
-    if not tables:
+# --- Insertions groupées ---
+# Borne prudente vis-à-vis de la limite de variables liées de SQLite
+BULK_CHUNK_SIZE = 500
+
+
+def bulk_insert(model, rows):
+    """Insère une liste de dicts via executemany, par paquets de BULK_CHUNK_SIZE lignes.
+
+    À appeler dans une transaction ouverte (``with db.session.begin():``).
+    """
+    for start in range(0, len(rows), BULK_CHUNK_SIZE):
+        db.session.execute(insert(model), rows[start:start + BULK_CHUNK_SIZE])
+
+
+# --- Initialisation de la base (commande « flask init-db ») ---
+DEFAULT_VACCINES = ('Typhus', 'Coryza', 'Leucose')
+DEFAULT_EMPLOYEES = ('Alice', 'Bob')
+
+
+def init_db():
+    """Crée le schéma et les données par défaut, ou complète les index d'une base existante.
+
+    Lancé une seule fois avant le démarrage des workers (``flask --app app init-db``),
+    pas à l'import : chaque worker gunicorn reste ainsi rapide à démarrer.
+    """
+    # Une seule requête sur sqlite_master plutôt que la réflexion complète de l'inspecteur
+    with db.engine.connect() as conn:
+        has_tables = conn.execute(text("SELECT 1 FROM sqlite_master WHERE type='table' LIMIT 1")).first()
+    if not has_tables:
         print("🔧 Initialisation de la base de données (premier lancement)...")
         db.create_all()
 
-        # Données par défaut
-        for name in ['Typhus', 'Coryza', 'Leucose']:
-            db.session.add(VaccineType(name=name))
-        for emp in ['Alice', 'Bob']:
-            db.session.add(Employee(name=emp))
-        db.session.commit()
+        # Données par défaut (une seule transaction, insertions groupées)
+        with db.session.begin():
+            bulk_insert(VaccineType, [{'name': name} for name in DEFAULT_VACCINES])
+            bulk_insert(Employee, [{'name': emp} for emp in DEFAULT_EMPLOYEES])
         print("✅ Base de données initialisée avec succès.")
+    else:
+        # Bases existantes : SQLite n'indexe pas les clés étrangères, on crée les index manquants
+        with db.engine.begin() as conn:
+            for table in db.metadata.sorted_tables:
+                for index in table.indexes:
+                    conn.execute(CreateIndex(index, if_not_exists=True))
+            # Statistiques sqlite_stat1 à jour pour que le planificateur choisisse les index
+            conn.execute(text("ANALYZE"))
+
+
+@app.cli.command('init-db')
+def init_db_command():
+    """Crée le schéma et les données par défaut."""
+    init_db()
+
+
+# --- Fichiers envoyés ---
+def upload_filename(client_filename):
+    """Génère un nom aléatoire en conservant l'extension (400 si elle n'est pas autorisée)."""
+    # Un seul test de suffixe (str.endswith accepte un tuple)
+    lowered = client_filename.lower()
+    if not lowered.endswith(ALLOWED_IMAGE_EXTENSIONS):
+        abort(400)
+    return secrets.token_hex(16) + lowered[lowered.rindex('.'):]
+
+
+def save_upload(stream, filename):
+    """Copie le flux envoyé dans UPLOAD_FOLDER sous le nom généré par upload_filename."""
+    path = os.path.join(UPLOAD_FOLDER_BYTES, os.fsencode(filename))
+    # O_EXCL : un nom aléatoire ne doit jamais écraser un fichier existant
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+    with os.fdopen(fd, 'wb', COPY_BUFSIZE) as dst:
+        shutil.copyfileobj(stream, dst, length=COPY_BUFSIZE)
+
+
+# --- Stratégie de chargement des relations ---
+def no_relationships():
+    """Option de requête pour les vues qui ne parcourent aucune relation.
+
+    En mode STRICT_LOADS, tout accès paresseux lève une erreur (détection des N+1).
+    """
+    return raiseload('*') if app.config['STRICT_LOADS'] else lazyload('*')
 
 
 # --- Routes principales ---
 @app.route('/')
 def index():
-    cats = Cat.query.all()
+    # index.html ne parcourt aucune relation de Cat
+    cats = Cat.query.options(no_relationships()).all()
     alerts = []
     return render_template('index.html', cats=cats, alerts=alerts)
 
 
+# Compteurs du dashboard mis en cache quelques secondes (vidé par les routes d'écriture)
+_dash_cache = TTLCache(maxsize=1, ttl=5)
+_dash_lock = threading.Lock()
+
+
+def invalidate_dashboard():
+    with _dash_lock:
+        _dash_cache.clear()
+
+
+@cached(_dash_cache, lock=_dash_lock)
+def dashboard_counts():
+    # Un seul aller-retour SQL pour les quatre compteurs
+    return tuple(db.session.execute(select(
+        *(select(func.count()).select_from(model).scalar_subquery()
+          for model in (Cat, Appointment, Employee, VaccineType))
+    )).one())
+
+
 @app.route('/dashboard')
 def dashboard():
-    total_cats = Cat.query.count()
-    total_appointments = Appointment.query.count()
-    total_employees = Employee.query.count()
-    total_vaccines = VaccineType.query.count()
+    total_cats, total_appointments, total_employees, total_vaccines = dashboard_counts()
 
     return render_template('dashboard.html',
                            total_cats=total_cats,
@@ -138,25 +306,29 @@ def api_cats():
         birthdate_str = request.form.get('birthdate')
         photo = request.files.get('photo')
 
-        birthdate = datetime.strptime(birthdate_str, '%Y-%m-%d').date() if birthdate_str else None
+        birthdate = date.fromisoformat(birthdate_str) if birthdate_str else None
         filename = None
         if photo:
-            filename = secure_filename(photo.filename)
-            photo.save(os.path.join(app.config['UPLOAD_FOLDER'], filename))
+            filename = upload_filename(photo.filename)
+            save_upload(photo.stream, filename)
 
         cat = Cat(name=name, status=status, birthdate=birthdate, photo_filename=filename)
-        db.session.add(cat)
-        db.session.commit()
+        with db.session.begin():
+            db.session.add(cat)
+        invalidate_dashboard()
         return redirect(url_for('index'))
 
-    cats = Cat.query.order_by(Cat.name).all()
+    # Projection directe des colonnes : pas d'objets ORM à hydrater
+    rows = db.session.execute(
+        select(Cat.id, Cat.name, Cat.status, Cat.birthdate, Cat.photo_filename).order_by(Cat.name)
+    ).all()
     return jsonify([{
-        "id": c.id,
-        "name": c.name,
-        "status": c.status,
-        "birthdate": c.birthdate.isoformat() if c.birthdate else None,
-        "photo": c.photo_filename
-    } for c in cats])
+        "id": r.id,
+        "name": r.name,
+        "status": r.status,
+        "birthdate": r.birthdate.isoformat() if r.birthdate else None,
+        "photo": r.photo_filename
+    } for r in rows])
 
 
 # --- API Rendez-vous ---
@@ -165,23 +337,81 @@ def api_appointments():
     if request.method == 'POST':
         date_str = request.form['date']
         location = request.form['location']
-        date = datetime.strptime(date_str, '%Y-%m-%dT%H:%M')
-        appointment = Appointment(date=date, location=location)
-        db.session.add(appointment)
-        db.session.commit()
+        date_value = datetime.fromisoformat(date_str)
+        try:
+            cat_ids = {int(x) for x in request.form.getlist('cat_ids')}
+            employee_ids = {int(x) for x in request.form.getlist('employee_ids')}
+        except ValueError:
+            abort(400)
+        appointment = Appointment(date=date_value, location=location)
+        with db.session.begin():
+            # Une requête IN par liste ; un identifiant inconnu rejette toute la requête (400)
+            found_cats = db.session.scalars(select(Cat.id).where(Cat.id.in_(cat_ids))).all() if cat_ids else []
+            found_employees = (
+                db.session.scalars(select(Employee.id).where(Employee.id.in_(employee_ids))).all()
+                if employee_ids else []
+            )
+            if len(found_cats) != len(cat_ids) or len(found_employees) != len(employee_ids):
+                abort(400)
+            db.session.add(appointment)
+            db.session.flush()
+            # Insertion groupée des lignes d'association
+            if found_cats:
+                bulk_insert(AppointmentCat, [
+                    {'appointment_id': appointment.id, 'cat_id': cid} for cid in found_cats
+                ])
+            if found_employees:
+                bulk_insert(AppointmentEmployee, [
+                    {'appointment_id': appointment.id, 'employee_id': eid} for eid in found_employees
+                ])
+        invalidate_dashboard()
         return jsonify({"success": True})
 
-    appointments = Appointment.query.all()
+    # Pagination par curseur (?after=<id>&limit=N), filtre optionnel ?start=&end= sur la date
+    limit = max(1, min(request.args.get('limit', 100, type=int), MAX_PAGE_SIZE))
+    after = request.args.get('after', 0, type=int)
+    query = select(Appointment.id, Appointment.date, Appointment.location).where(Appointment.id > after)
+    try:
+        start = datetime.fromisoformat(request.args['start']) if request.args.get('start') else None
+        end = datetime.fromisoformat(request.args['end']) if request.args.get('end') else None
+    except ValueError:
+        abort(400)
+    if start:
+        query = query.where(Appointment.date >= start)
+    if end:
+        query = query.where(Appointment.date < end)
+    appointments = db.session.execute(query.order_by(Appointment.id).limit(limit)).all()
+    appt_ids = [a.id for a in appointments]
+
+    # Flux de tuples (rendez-vous, nom) : aucune instance ORM pour les tables d'association
+    cats_by_appt = {}
+    for appt_id, name in db.session.execute(
+        select(AppointmentCat.appointment_id, Cat.name)
+        .join(Cat, Cat.id == AppointmentCat.cat_id)
+        .where(AppointmentCat.appointment_id.in_(appt_ids))
+        .order_by(AppointmentCat.id)
+    ):
+        cats_by_appt.setdefault(appt_id, []).append(name)
+    employees_by_appt = {}
+    for appt_id, name in db.session.execute(
+        select(AppointmentEmployee.appointment_id, Employee.name)
+        .join(Employee, Employee.id == AppointmentEmployee.employee_id)
+        .where(AppointmentEmployee.appointment_id.in_(appt_ids))
+        .order_by(AppointmentEmployee.id)
+    ):
+        employees_by_appt.setdefault(appt_id, []).append(name)
+
     return jsonify({
         "count": len(appointments),
+        "next_after": appt_ids[-1] if len(appt_ids) == limit else None,
         "items": [
             {
                 "id": a.id,
                 "date_db": a.date.strftime('%Y-%m-%d %H:%M:%S'),
                 "date_iso": a.date.isoformat(),
                 "location": a.location,
-                "cats": [ac.cat.name for ac in a.cats],
-                "employees": [ae.employee.name for ae in a.employees]
+                "cats": cats_by_appt.get(a.id, []),
+                "employees": employees_by_appt.get(a.id, [])
             } for a in appointments
         ]
     })
@@ -192,26 +422,47 @@ def api_employees():
     if request.method == 'POST':
         name = request.form['name']
         emp = Employee(name=name)
-        db.session.add(emp)
-        db.session.commit()
+        with db.session.begin():
+            db.session.add(emp)
+        invalidate_dashboard()
         return jsonify({"success": True})
 
     emps = Employee.query.all()
     return jsonify([{"id": e.id, "name": e.name} for e in emps])
 
 
+# Types de vaccins quasi immuables : gardés en mémoire, vidés à chaque ajout.
+# Le TTL fait converger les autres workers gunicorn sans communication entre eux.
+_vaccine_types_cache = TTLCache(maxsize=1, ttl=60)
+_vaccine_types_lock = threading.Lock()
+
+
+def invalidate_vaccine_types():
+    with _vaccine_types_lock:
+        _vaccine_types_cache.clear()
+
+
+@cached(_vaccine_types_cache, lock=_vaccine_types_lock)
+def get_vaccine_types():
+    rows = db.session.execute(select(VaccineType.id, VaccineType.name)).all()
+    return [{"id": r.id, "name": r.name} for r in rows]
+
+
 @app.route('/api/vaccines', methods=['GET', 'POST'])
 def api_vaccines():
     if request.method == 'POST':
         name = request.form['name']
         v = VaccineType(name=name)
-        db.session.add(v)
-        db.session.commit()
+        with db.session.begin():
+            db.session.add(v)
+        invalidate_vaccine_types()
+        invalidate_dashboard()
         return jsonify({"success": True})
-    vaccines = VaccineType.query.all()
-    return jsonify([{"id": v.id, "name": v.name} for v in vaccines])
+    return jsonify(get_vaccine_types())
 
 
 # --- Lancement ---
 if __name__ == '__main__':
+    with app.app_context():
+        init_db()
     app.run(debug=True, host='0.0.0.0', port=5000)